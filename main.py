@@ -3,16 +3,21 @@ import re
 import sys
 import argparse
 import time
+import math
+import random
 import io
 import contextlib
 import subprocess
 import traceback
-from typing import List, Optional, Tuple
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 
 # 第三方库
+import httpx
 import r2pipe
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIStatusError, DefaultHttpxClient, OpenAI
 from rich.console import Console, Group
 from rich.panel import Panel
 from rich.markdown import Markdown
@@ -25,6 +30,13 @@ from rich.syntax import Syntax
 from rich.live import Live
 from rich.spinner import Spinner
 
+# HTTP/2 需要 h2 (依赖中的 httpx[http2] 会安装)；手动安装依赖时若缺少则退回 HTTP/1.1 keep-alive
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 # 加载环境变量
 load_dotenv()
 
@@ -40,11 +52,106 @@ custom_theme = Theme({
 })
 console = Console(theme=custom_theme)
 
+# 显示时的高亮替换表，单次扫描完成全部替换
+_DISPLAY_MAP = {
+    "[[": "`[[",
+    "]]": "]]`",
+    "<py>": "\n```python\n",
+    "</py>": "\n```\n",
+}
+_DISPLAY_RE = re.compile(r"\[\[|\]\]|<py>|</py>")
+
+# 用户输入这些命令时退出
+_EXIT_CMDS = frozenset({"exit", "quit", "q"})
+
+# 历史记录压缩：总字符数超过上限时，将较早的消息总结为一段摘要
+_HISTORY_CHAR_LIMIT = 60000
+_HISTORY_RESULT_CLIP = 4000 # 较早的执行结果在历史中保留的最大字符数
+_SUMMARY_MESSAGE_CLIP = 2000 # 送去总结时每条旧消息的最大字符数
+_SUMMARY_MAX_CHARS = 4000 # 摘要的最大字符数
+
+# 每轮回传给模型的执行结果最大字符数
+_RESULT_CHAR_LIMIT = 30000
+_DISCARDED_OUTPUT_CLIP = 2000 # 被丢弃的请求中已执行命令的输出最大字符数
+
+# Python 代码输出捕获上限 (字节)，超出部分直接丢弃
+_PYTHON_OUTPUT_LIMIT = 30000
+
+def _iter_actions(text: str) -> Iterator[Tuple[str, str]]:
+    """依次产出完整的 [[r2 命令]] 或 <py>Python 代码</py>，返回 (类型, 原始内容)
+
+    只用 str.find 向前扫描，不回溯；两种起始标记的位置会被缓存，
+    只有被越过时才重新查找，整体为一次线性扫描。
+    """
+    r2_start = text.find("[[")
+    py_start = text.find("<py>")
+    while r2_start != -1 or py_start != -1:
+        if py_start == -1 or (r2_start != -1 and r2_start < py_start):
+            end = text.find("]]", r2_start + 2)
+            if end == -1:
+                r2_start = -1 # 之后不存在闭合的 ]]
+                continue
+            yield "r2", text[r2_start + 2:end]
+            pos = end + 2
+        else:
+            end = text.find("</py>", py_start + 4)
+            if end == -1:
+                py_start = -1 # 之后不存在闭合的 </py>
+                continue
+            yield "python", text[py_start + 4:end]
+            pos = end + 5
+        if r2_start != -1 and r2_start < pos:
+            r2_start = text.find("[[", pos)
+        if py_start != -1 and py_start < pos:
+            py_start = text.find("<py>", pos)
+
+class _CappedWriter(io.TextIOBase):
+    """stdout 替代品：只保留前 limit 字节的输出，超出部分直接丢弃"""
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.truncated = False
+        self._buf = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if not self.truncated:
+            data = s.encode("utf-8", errors="replace")
+            room = self.limit - len(self._buf)
+            if len(data) > room:
+                data = data[:room]
+                self.truncated = True
+            self._buf += data
+        return len(s)
+
+    def getvalue(self) -> str:
+        output = self._buf.decode("utf-8", errors="ignore")
+        if self.truncated:
+            output += "\n... [Output Truncated] ..."
+        return output
+
+@functools.lru_cache(maxsize=64)
+def _compile_agent_code(code: str):
+    """编译 Agent 生成的 Python 代码，相同代码片段复用已编译的 code 对象"""
+    return compile(code, "<agent>", "exec")
+
 class R2AutoAgent:
+    """r2auto 代理：流式请求 LLM，解析并执行其中的 r2 命令与 Python 代码
+
+    性能瓶颈在 I/O 与终端渲染 (网络流式响应、r2pipe 进程通信、Rich 输出)，
+    没有数值计算热点，引入 Numba/Cython 只会增加启动时间。优化应集中在：
+    流式渲染避免重复处理全文、r2 命令与流式输出重叠、历史记录压缩、网络重试退避。
+    """
+
     def __init__(self, target_file: str):
         self.target_file = target_file
         self.client = self._init_openai()
         self.r2 = self._init_r2()
+        # r2pipe 不是线程安全的，所有后台 r2 命令都在同一个工作线程上串行执行
+        self._r2_executor = ThreadPoolExecutor(max_workers=1)
         self.history = []
         self.system_prompt = self._get_system_prompt()
         
@@ -55,7 +162,27 @@ class R2AutoAgent:
         if not base_url or not api_key:
             console.print("[danger]Error: .env file missing OPENAI_BASE_URL or OPENAI_API_KEY[/danger]")
             sys.exit(1)
-        return OpenAI(base_url=base_url, api_key=api_key, default_headers=({"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Cherry Studio/0.7.3 Chrome/122.0.6261.156 Electron/29.1.5 Safari/537.36"}))
+        # 请求参数骨架只构建一次，每轮只替换 messages
+        model_name = os.getenv("OPENAI_MODEL", "gpt-4")
+        self._base_req_kwargs = {
+            "model": model_name,
+            "stream": True,
+            "timeout": 60.0,
+            # 启用 Thinking (默认使用 8192 token 额度)
+            "extra_body": {
+                "thinking": {
+                    "type": "enabled",
+                    "budget_tokens": 8192
+                }
+            },
+        }
+        self.thinking_supported = True
+        # 整个会话复用同一个连接池，避免每轮重新建立 TCP/TLS 连接
+        http_client = DefaultHttpxClient(
+            http2=_HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+        )
+        return OpenAI(base_url=base_url, api_key=api_key, http_client=http_client, default_headers=({"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Cherry Studio/0.7.3 Chrome/122.0.6261.156 Electron/29.1.5 Safari/537.36"}))
 
     def _init_r2(self):
         """初始化 r2pipe"""
@@ -108,8 +235,37 @@ Your goal is to analyze the binary provided based on the user's request.
         except Exception as e:
             return f"R2 Error executing '{cmd}': {str(e)}"
 
+    def _prefetch_r2_commands(self, text: str, pos: int, prefetched: List[Tuple[str, Future]]) -> Optional[int]:
+        """流式输出期间，将已完整输出的 r2 命令提前提交到工作线程执行
+
+        只预取第一个 <py> 之前的命令，保证执行顺序与 parse_response 一致。
+        返回下次扫描的起始位置；遇到 Python 代码块后返回 None，停止预取。
+        """
+        while True:
+            r2_start = text.find("[[", pos)
+            # 只需检查下一个命令之前是否出现 <py>
+            if text.find("<py>", pos, len(text) if r2_start == -1 else r2_start) != -1:
+                return None
+            if r2_start == -1:
+                # 跳过已扫描的内容，只保留末尾可能被截断的标记前缀
+                return max(pos, len(text) - 3)
+            end = text.find("]]", r2_start + 2)
+            if end == -1:
+                return r2_start # 命令尚未输出完整，等待后续内容
+            raw_content = text[r2_start + 2:end]
+            pos = end + 2
+            cmd_content = raw_content.strip()
+            if raw_content and cmd_content != "ask":
+                prefetched.append((cmd_content, self._r2_executor.submit(self.run_r2_command, cmd_content)))
+
     def run_python_code(self, code: str) -> str:
-        buffer = io.StringIO()
+        buffer = _CappedWriter(_PYTHON_OUTPUT_LIMIT)
+        try:
+            compiled = _compile_agent_code(code)
+        except SyntaxError as e:
+            # 部分错误没有行号 (例如代码中包含空字节)
+            location = f" at line {e.lineno}" if e.lineno is not None else ""
+            return f"Python Execution Error:\nSyntaxError: {e.msg}{location}"
         try:
             exec_globals = {
                 "r2": self.r2,
@@ -119,40 +275,139 @@ Your goal is to analyze the binary provided based on the user's request.
                 "json": __import__('json')
             }
             with contextlib.redirect_stdout(buffer):
-                exec(code, exec_globals)
+                exec(compiled, exec_globals)
             output = buffer.getvalue()
             return output if output else "(Python executed successfully, no output)"
-        except Exception:
-            return f"Python Execution Error:\n{traceback.format_exc()}"
+        except Exception as e:
+            # 只保留最内层的 2 帧，减少回传给模型的无关信息
+            tb_lines = traceback.format_exception(type(e), e, e.__traceback__, limit=-2)
+            return f"Python Execution Error:\n{''.join(tb_lines)}"
 
     def parse_response(self, text: str) -> Tuple[List[dict], bool]:
         actions = []
-        has_ask = "[[ask]]" in text
-        pattern = re.compile(r"(\[\[(.*?)\]\]|<py>(.*?)</py>)", re.DOTALL)
-        matches = pattern.finditer(text)
+        has_ask = False
         
-        for match in matches:
-            r2_cmd = match.group(2)
-            py_code = match.group(3)
-            if r2_cmd:
-                cmd_content = r2_cmd.strip()
-                if cmd_content != "ask":
+        for act_type, raw_content in _iter_actions(text):
+            if act_type == "r2" and raw_content:
+                cmd_content = raw_content.strip()
+                if cmd_content == "ask":
+                    has_ask = True
+                else:
                     actions.append({"type": "r2", "content": cmd_content})
-            elif py_code:
-                actions.append({"type": "python", "content": py_code.strip()})
+            elif act_type == "python" and raw_content:
+                actions.append({"type": "python", "content": raw_content.strip()})
         
         return actions, has_ask
 
     def format_display_content(self, content: str) -> str:
         """辅助函数：处理显示时的文本替换，增加高亮"""
-        return content.replace("[[", "`[[").replace("]]", "]]`") \
-                      .replace("<py>", "\n```python\n").replace("</py>", "\n```\n")
+        return _DISPLAY_RE.sub(lambda m: _DISPLAY_MAP[m.group(0)], content)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """计算重试等待时间：429 优先使用 Retry-After，否则指数退避加随机抖动"""
+        if isinstance(error, APIStatusError) and error.status_code == 429:
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = None
+            # 忽略 nan/inf 等异常值，负数按 0 处理，避免 time.sleep 抛出异常
+            if delay is not None and math.isfinite(delay):
+                return max(0.0, min(delay, 60.0))
+        return min(2 ** attempt + random.random(), 30.0)
+
+    def _append_result(self, execution_results: List[str], entry: str, results_len: int) -> Tuple[int, bool]:
+        """辅助函数：在 _RESULT_CHAR_LIMIT 内追加一条执行结果，返回 (已收集字符数, 是否发生截断)"""
+        sep_len = 1 if results_len else 0 # 结果之间以换行连接
+        room = _RESULT_CHAR_LIMIT - results_len - sep_len
+        truncated = len(entry) > room
+        if truncated:
+            entry = entry[:max(room, 0)]
+        if entry:
+            execution_results.append(entry)
+            results_len += sep_len + len(entry)
+        return results_len, truncated
+
+    def _flush_prose(self, prose_buf: List[str]):
+        """辅助函数：将缓存的普通文本行作为一段 Markdown 渲染并清空缓存"""
+        if prose_buf:
+            # 用硬换行连接，保留模型逐行输出的换行 (单个换行在 Markdown 中会被合并为空格)
+            console.print(Markdown("  \n".join(prose_buf)))
+            prose_buf.clear()
+
+    def _flush_code(self, code_buf: List[str]):
+        """辅助函数：将缓存的代码行作为一个整体高亮渲染并清空缓存"""
+        if code_buf:
+            console.print(
+                Syntax("\n".join(code_buf), "python", theme="monokai",
+                       line_numbers=True, start_line=1,
+                       word_wrap=True, padding=(0, 1))
+            )
+            code_buf.clear()
+
+    def _compact_history(self):
+        """控制历史长度：截断较早的执行结果，仍超出上限时将较早的消息总结并入初始请求"""
+        truncated_note = "\n... [Output Truncated] ..."
+        # 最新一条消息保持完整，更早的执行结果截断到单条上限
+        for message in self.history[2:-1]:
+            content = message["content"]
+            if message["role"] == "user" and content.startswith("Execution Results:") and len(content) > _HISTORY_RESULT_CLIP:
+                message["content"] = content[:_HISTORY_RESULT_CLIP - len(truncated_note)] + truncated_note
+        if sum(len(m["content"]) for m in self.history) <= _HISTORY_CHAR_LIMIT:
+            return
+
+        # 按字符预算从后往前选取保留的消息 (至少保留最新一条)；
+        # history[1] 是 user 消息，保留部分须从 assistant 开始才能保持角色交替
+        cut = len(self.history) - 1
+        tail_len = len(self.history[cut]["content"])
+        while cut > 3 and tail_len + len(self.history[cut - 1]["content"]) <= _HISTORY_CHAR_LIMIT // 2:
+            cut -= 1
+            tail_len += len(self.history[cut]["content"])
+        while cut > 2 and self.history[cut]["role"] != "assistant":
+            cut -= 1
+            tail_len += len(self.history[cut]["content"])
+        if cut <= 2:
+            return
+
+        # 只有压缩后确实能回到上限以内时才调用模型总结
+        head_len = len(self.history[0]["content"]) + len(self._initial_request) + _SUMMARY_MAX_CHARS
+        if head_len + tail_len > _HISTORY_CHAR_LIMIT:
+            return
+
+        transcript = "\n\n".join(
+            f"[{m['role']}]\n{m['content'][:_SUMMARY_MESSAGE_CLIP]}" for m in self.history[2:cut]
+        )
+        if self._history_summary:
+            transcript = f"[earlier summary]\n{self._history_summary}\n\n{transcript}"
+        try:
+            with Status("Compacting conversation history...", spinner="dots", spinner_style="cyan"):
+                response = self.client.chat.completions.create(
+                    model=self._base_req_kwargs["model"],
+                    messages=[
+                        {"role": "system", "content": "Summarize this reverse engineering session transcript. Keep concrete findings: addresses, function names, strings, algorithms, and conclusions. Be concise."},
+                        {"role": "user", "content": transcript},
+                    ],
+                    stream=False,
+                    timeout=60.0,
+                )
+            summary = response.choices[0].message.content or ""
+        except Exception as e:
+            console.print(f"[warning]History summarization failed ({e}), keeping the most recent part of the old transcript instead.[/warning]")
+            summary = transcript[-_SUMMARY_MAX_CHARS:]
+        self._history_summary = summary[:_SUMMARY_MAX_CHARS]
+
+        self.history = [
+            self.history[0],
+            {"role": "user", "content": f"{self._initial_request}\n\nSummary of earlier analysis:\n{self._history_summary}"},
+        ] + self.history[cut:]
 
     def chat_loop(self, initial_prompt: str):
         """主循环"""
+        self._initial_request = f"Target: {self.target_file}\nRequest: {initial_prompt}"
+        self._history_summary = "" # 历史压缩后的摘要，并入初始请求中
         self.history = [
             {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": f"Target: {self.target_file}\nRequest: {initial_prompt}"}
+            {"role": "user", "content": self._initial_request}
         ]
         
         console.rule("[bold cyan]r2auto Session Started")
@@ -160,30 +415,23 @@ Your goal is to analyze the binary provided based on the user's request.
         while True:
             # 1. LLM 思考并流式生成回复
             full_content = ""
+            self._compact_history()
             
             # 准备参数
-            model_name = os.getenv("OPENAI_MODEL", "gpt-4")
-            req_kwargs = {
-                "model": model_name,
-                "messages": self.history,
-                "stream": True,
-            }
-            # 启用 Thinking (默认使用 8192 token 额度)
-            req_kwargs["extra_body"] = {
-                "thinking": {
-                    "type": "enabled",
-                    "budget_tokens": 8192
-                }
-            }
+            req_kwargs = {**self._base_req_kwargs, "messages": self.history}
             
             # 状态与动画字符
             is_thinking = False
             spinner_chars = ["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"]
             
-            # 设置超时和重试
-            req_kwargs['timeout'] = 60.0
+            # 设置重试
             max_retries = 3
 
+            # 流式阶段提前执行的 r2 命令 (命令, Future)
+            prefetched = []
+            # 失败请求中已经开始执行、无法撤销的预取命令，需要告知用户与模型
+            discarded_runs = []
+
             try:
                 # 使用 transient=True 让 Live 结束后自动清除状态栏，避免残留
                 with Live(console=console, refresh_per_second=10, transient=True) as live:
@@ -192,9 +440,19 @@ Your goal is to analyze the binary provided based on the user's request.
                         thinking_content = "" # 重置 thinking 缓冲区
                         
                         # 流式输出状态变量
-                        printed_len = 0
+                        pending_tail = "" # 尚未打印的不完整行
+                        last_update = 0.0 # 上次刷新状态栏的时间
+                        end_window = "" # 上一段内容末尾，用于检测跨 chunk 的 [end]
+                        seen_end = False
                         in_code_block = False
-                        code_line_count = 1
+                        code_buf = [] # 当前代码块的行，代码块结束时整体高亮
+                        prose_buf = [] # 待渲染的连续普通文本行，按段落批量渲染
+                        # 丢弃上一次失败请求中尚未执行的预取命令，已执行的记录下来
+                        for cmd_content, future in prefetched:
+                            if not future.cancel():
+                                discarded_runs.append((cmd_content, future))
+                        prefetched = []
+                        prefetch_pos = 0 # None 表示已停止预取
                         
                         try:
                             # Initial waiting state or Retrying state
@@ -213,8 +471,11 @@ Your goal is to analyze the binary provided based on the user's request.
                             try:
                                 stream = self.client.chat.completions.create(**req_kwargs)
                             except Exception as e:
-                                if "thinking" in str(e).lower() or "parameter" in str(e).lower() or "400" in str(e):
+                                if self.thinking_supported and ("thinking" in str(e).lower() or "parameter" in str(e).lower() or "400" in str(e)):
                                     # console.print("[dim]Thinking parameter not supported, disabling...[/dim]")
+                                    # 记住不支持 thinking，后续轮次直接不带该参数
+                                    self.thinking_supported = False
+                                    self._base_req_kwargs.pop("extra_body", None)
                                     req_kwargs.pop("extra_body", None)
                                     stream = self.client.chat.completions.create(**req_kwargs)
                                 else:
@@ -232,6 +493,7 @@ Your goal is to analyze the binary provided based on the user's request.
                                     delta_reasoning = (delta.model_extra or {}).get('reasoning_text', '') or ""
                                 
                                 # 如果有 reasoning 内容，标记为 thinking 状态
+                                was_thinking = is_thinking
                                 if delta_reasoning:
                                     is_thinking = True
                                     thinking_content += delta_reasoning
@@ -240,83 +502,93 @@ Your goal is to analyze the binary provided based on the user's request.
                                     
                                 if delta_content:
                                     full_content += delta_content
-
-                                # --- 流式增量输出逻辑 (修复长文本闪烁问题) ---
-                                if full_content:
-                                    formatted_text = self.format_display_content(full_content)
-                                    # 检查是否有新的完整行
-                                    if '\n' in formatted_text[printed_len:]:
-                                        available_text = formatted_text[printed_len:]
-                                        last_newline_idx = available_text.rfind('\n')
-                                        
-                                        if last_newline_idx != -1:
-                                            chunk_to_print = available_text[:last_newline_idx + 1]
-                                            lines = chunk_to_print.split('\n')
-                                            # split('a\n') -> ['a', ''] 所以忽略最后一个空元素
-                                            lines_to_process = lines[:-1]
-                                            
-                                            for line in lines_to_process:
-                                                stripped = line.strip()
-                                                
-                                                if stripped == "```python":
-                                                    in_code_block = True
-                                                    code_line_count = 1
-                                                    # 打印一个小标题区分代码块
-                                                    console.print(Text("  Python Code:", style="dim cyan"))
-                                                    continue
-                                                if stripped == "```" and in_code_block:
-                                                    in_code_block = False
-                                                    console.print() # 代码块结束空一行
-                                                    continue
-
-                                                if in_code_block:
-                                                    # 使用 Syntax 高亮代码行
-                                                    console.print(
-                                                        Syntax(line, "python", theme="monokai", 
-                                                               line_numbers=True, start_line=code_line_count,
-                                                               word_wrap=True, padding=(0, 1))
-                                                    )
-                                                    code_line_count += 1
+                                    # 只在新增内容及其前 4 个字符中查找 [end]，避免每个 chunk 扫描全文
+                                    end_window += delta_content
+                                    if "[end]" in end_window:
+                                        seen_end = True
+                                    end_window = end_window[-4:]
+                                    # 命令闭合时才可能出现新的完整 r2 命令
+                                    if prefetch_pos is not None and "]" in delta_content:
+                                        prefetch_pos = self._prefetch_r2_commands(full_content, prefetch_pos, prefetched)
+
+                                # --- 流式增量输出逻辑 (只处理新增部分，避免重复格式化整个缓冲区) ---
+                                if delta_content:
+                                    # 换行只可能出现在新增内容中，只在 delta 内查找再加上偏移
+                                    last_newline_idx = delta_content.rfind('\n')
+                                    if last_newline_idx != -1:
+                                        last_newline_idx += len(pending_tail)
+                                    pending_tail += delta_content
+                                    if last_newline_idx != -1:
+                                        chunk_to_print = self.format_display_content(pending_tail[:last_newline_idx + 1])
+                                        pending_tail = pending_tail[last_newline_idx + 1:]
+                                        lines = chunk_to_print.split('\n')
+                                        # split('a\n') -> ['a', ''] 所以忽略最后一个空元素
+                                        lines_to_process = lines[:-1]
+
+                                        for line in lines_to_process:
+                                            stripped = line.strip()
+
+                                            if stripped == "```python":
+                                                self._flush_prose(prose_buf)
+                                                in_code_block = True
+                                                # 打印一个小标题区分代码块
+                                                console.print(Text("  Python Code:", style="dim cyan"))
+                                                continue
+                                            if stripped == "```" and in_code_block:
+                                                in_code_block = False
+                                                self._flush_code(code_buf)
+                                                console.print() # 代码块结束空一行
+                                                continue
+
+                                            if in_code_block:
+                                                code_buf.append(line)
+                                            else:
+                                                # 普通 Markdown 文本，遇到空行时整段渲染
+                                                if line:
+                                                     prose_buf.append(line)
                                                 else:
-                                                    # 普通 Markdown 文本
-                                                    if line:
-                                                         console.print(Markdown(line))
-                                                    else:
-                                                         console.print("")
-
-                                            printed_len += (last_newline_idx + 1)
-
-                                # --- 底部状态栏更新 ---
-                                spinner_idx = int(time.time() * 12) % len(spinner_chars)
-                                spinner_char = spinner_chars[spinner_idx]
-                                
-                                if is_thinking:
-                                    # 显示最后5行思考过程
-                                    lines = [l for l in thinking_content.split('\n') if l.strip()]
-                                    tail = "\n".join(lines[-5:]) if lines else ""
+                                                     self._flush_prose(prose_buf)
+                                                     console.print("")
+
+                                # --- 底部状态栏更新 (Live 每秒只刷新 10 次，按刷新间隔节流) ---
+                                now = time.monotonic()
+                                if now - last_update >= 0.1 or is_thinking != was_thinking:
+                                    last_update = now
+                                    spinner_idx = int(time.time() * 12) % len(spinner_chars)
+                                    spinner_char = spinner_chars[spinner_idx]
                                     
-                                    status_header = Text(f"{spinner_char} Thinking...", style="italic blue")
-                                    if tail:
-                                        status_bar = Group(
-                                            status_header, 
-                                            Text(tail, style="dim white")
-                                        )
+                                    if is_thinking:
+                                        # 显示最后5行思考过程
+                                        lines = [l for l in thinking_content.split('\n') if l.strip()]
+                                        tail = "\n".join(lines[-5:]) if lines else ""
+                                        
+                                        status_header = Text(f"{spinner_char} Thinking...", style="italic blue")
+                                        if tail:
+                                            status_bar = Group(
+                                                status_header, 
+                                                Text(tail, style="dim white")
+                                            )
+                                        else:
+                                            status_bar = status_header
                                     else:
-                                        status_bar = status_header
-                                else:
-                                    status_bar = Text(f"{spinner_char} Generating Response...", style="green")
+                                        status_bar = Text(f"{spinner_char} Generating Response...", style="green")
 
-                                live.update(Panel(status_bar, title="r2auto Info", border_style="dim blue"))
+                                    live.update(Panel(status_bar, title="r2auto Info", border_style="dim blue"))
                                     
-                                if "[end]" in full_content and not is_thinking:
+                                if seen_end and not is_thinking:
                                     break
                             
+                            self._flush_code(code_buf)
+                            self._flush_prose(prose_buf)
                             # 成功跳出内层循环
                             break
                         
                         except Exception as e:
-                            # 如果是循环中的异常（超时等）
+                            # 如果是循环中的异常（超时等），退避后重试
                             if attempt < max_retries - 1:
+                                delay = self._retry_delay(e, attempt)
+                                live.update(Panel(f"Request failed ({type(e).__name__}). Retrying in {delay:.1f}s...", title="r2auto", border_style="yellow"))
+                                time.sleep(delay)
                                 continue
                             else:
                                 raise e # 抛出给外层捕获
@@ -331,38 +603,58 @@ Your goal is to analyze the binary provided based on the user's request.
             # 2. 解析动作序列 (逻辑不变)
             actions, has_ask = self.parse_response(full_content)
 
-            # 3. 执行动作 (逻辑不变)
-            if actions:
-                execution_results = []
-                for action in actions:
+            # 3. 执行动作 (流式阶段已提交的 r2 命令直接取结果)
+            if actions or discarded_runs:
+                execution_results = ["Execution Results:"]
+                results_len = 0 # 已收集结果的字符数 (含分隔换行)
+                truncated = False
+
+                # 失败请求中已执行的命令可能改变了 r2 状态 (seek、配置、写入等)，如实回报
+                for cmd_content, future in discarded_runs:
+                    console.print(f"[warning]➜ Already executed by a discarded response: {cmd_content}[/warning]")
+                    output = future.result()[:_DISCARDED_OUTPUT_CLIP]
+                    entry = f"R2 Command (already executed by a discarded, retried response): [[{cmd_content}]]\nOutput:\n{output}"
+                    if not truncated:
+                        results_len, truncated = self._append_result(execution_results, entry, results_len)
+
+                for idx, action in enumerate(actions):
                     act_type = action["type"]
                     act_content = action["content"]
 
                     if act_type == "r2":
                         console.print(f"[cmd]➜ R2 Command: {act_content}[/cmd]")
+                        if idx < len(prefetched) and prefetched[idx][0] == act_content:
+                            future = prefetched[idx][1]
+                        else:
+                            future = self._r2_executor.submit(self.run_r2_command, act_content)
                         with Status(f"Running r2 '{act_content}'...", spinner="bouncingBall", spinner_style="yellow"):
-                            output = self.run_r2_command(act_content)
-                        execution_results.append(f"R2 Command: [[{act_content}]]\nOutput:\n{output}")
+                            output = future.result()
+                        entry = f"R2 Command: [[{act_content}]]\nOutput:\n{output}"
                     
                     elif act_type == "python":
                         console.print(f"[py]➜ Executing Python Code...[/py]")
                         console.print(Syntax(act_content, "python", theme="monokai", line_numbers=False))
                         with Status(f"Running Python logic...", spinner="aesthetic", spinner_style="blue"):
+                            # 等待工作线程空闲，避免与 Python 代码同时访问 r2pipe
+                            self._r2_executor.submit(lambda: None).result()
                             output = self.run_python_code(act_content)
                         
                         if len(output) < 5000:
                             console.print(Panel(output, title="Python Output", border_style="dim blue"))
                         else:
                             console.print(f"[dim]Python output length: {len(output)} chars[/dim]")
-                        execution_results.append(f"Python Code Execution:\nOutput:\n{output}")
+                        entry = f"Python Code Execution:\nOutput:\n{output}"
+
+                    # 超出上限后不再收集结果，动作仍继续执行
+                    if not truncated:
+                        results_len, truncated = self._append_result(execution_results, entry, results_len)
 
-                result_text = "\n".join(execution_results)
-                if len(result_text) > 30000:
-                    result_text = result_text[:30000] + "\n... [Output Truncated] ..."
+                if truncated:
+                    execution_results.append("... [Output Truncated] ...")
 
                 self.history.append({
                     "role": "user", 
-                    "content": f"Execution Results:\n{result_text}"
+                    "content": "\n".join(execution_results)
                 })
                 
                 if not has_ask:
@@ -371,7 +663,7 @@ Your goal is to analyze the binary provided based on the user's request.
             # 4. 处理询问 ([[ask]])
             if has_ask:
                 user_input = Prompt.ask("[bold green]User Input[/bold green]")
-                if user_input.lower() in ['exit', 'quit', 'q']:
+                if user_input and user_input.lower() in _EXIT_CMDS:
                     console.print("[info]Exiting r2auto.[/info]")
                     break
                 self.history.append({"role": "user", "content": user_input})
@@ -381,7 +673,7 @@ Your goal is to analyze the binary provided based on the user's request.
             if not actions and not has_ask:
                 console.print("[warning]Agent paused. Waiting for input...[/warning]")
                 user_input = Prompt.ask("[bold green]User Input[/bold green]")
-                if user_input.lower() in ['exit', 'quit', 'q']:
+                if user_input and user_input.lower() in _EXIT_CMDS:
                     break
                 self.history.append({"role": "user", "content": user_input})
 